@@ -1,17 +1,42 @@
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Tuple, Callable, Optional
 from overrides import overrides
+import contextlib
 import logging
+from operator import itemgetter
 import torch
 
 from allennlp.data import TextFieldTensors, Vocabulary
 from allennlp.models.model import Model
 from allennlp.modules import Seq2VecEncoder, TextFieldEmbedder
+from allennlp.modules.seq2vec_encoders import ClsPooler
 from allennlp.nn.util import get_text_field_mask
 from allennlp.modules import InputVariationalDropout
 
 logger = logging.getLogger(__name__)
 
 
+def _identity(metric: Any) -> Any:
+    return metric
+
+
+# maps the (lowercased) metric name to the function extracting the score used in MachampModel.get_metrics()
+_METRIC_HANDLERS: Dict[str, Callable[[Any], float]] = {
+    'acc': _identity,
+    'ppl': _identity,
+    'las': itemgetter('LAS'),
+    'micro-f1': itemgetter('fscore'),
+    'macro-f1': itemgetter('fscore'),
+    'span_f1': itemgetter('f1-measure-overall'),
+    'multi_span_f1': itemgetter('f1-measure-overall'),
+    'bleu': itemgetter('BLEU'),
+}
+
+
+@torch.jit.script
+def _sum_losses(losses: List[torch.Tensor]) -> torch.Tensor:
+    return torch.stack(losses).sum()
+
+
 @Model.register("machamp_model")
 class MachampModel(Model):
     """
@@ -26,6 +51,9 @@ class MachampModel(Model):
             tasks: List[str],
             task_types: List[str],
             dropout: float = None,
+            variational: bool = True,
+            bf16_autocast: bool = False,
+            parallel_decoders: bool = False,
             **kwargs
     ) -> None:
         super().__init__(vocab, **kwargs)
@@ -33,9 +61,15 @@ class MachampModel(Model):
 
         self.encoder = encoder
         self._classifier_input_dim = self.encoder.get_output_dim()
+        # the cls_pooler only looks at the mask when the cls token is the last token (this reads a private
+        # attribute of allennlp, if it is missing we fall back to always computing the mask)
+        cls_is_first_token = isinstance(encoder, ClsPooler) and not getattr(encoder, '_cls_is_last_token', True)
+        self._encoder_needs_mask = not cls_is_first_token
 
         if dropout:
-            self._dropout = InputVariationalDropout(dropout)
+            # variational dropout shares the dropout mask over all tokens of a sentence, the plain
+            # dropout is cheaper as it does not need to build and broadcast a separate mask
+            self._dropout = InputVariationalDropout(dropout) if variational else torch.nn.Dropout(dropout)
             self._dropout_sents = torch.nn.Dropout(dropout)
         else:
             self._dropout = None
@@ -44,10 +78,81 @@ class MachampModel(Model):
 
         self.tasks = tasks
         self.task_types = task_types
+        # bfloat16 autocast needs torch>=1.10; float16 (on older versions) needs loss scaling, which is
+        # handled by the "use_amp" option of the trainer instead
+        if bf16_autocast and not hasattr(torch, 'autocast'):
+            logger.warning("bf16_autocast requires torch>=1.10, disabling it. For float16 mixed precision " +
+                           "use \"use_amp\": true in the trainer config, which also scales the loss.")
+            bf16_autocast = False
+        self.bf16_autocast = bf16_autocast
+        # the decoders are independent of each other, so they can run on separate cuda streams; these
+        # are created on first use, so that the model can still be constructed without a gpu
+        self.parallel_decoders = parallel_decoders
+        # streams are kept per device, as the model can be moved to another gpu after the first batch
+        self._streams: Dict[torch.device, List[torch.cuda.Stream]] = {}
+
+        # tasks and task_types are fixed, so all label keys used in forward() can be precomputed once,
+        # together with a direct reference to the decoder (it stays registered in self.decoders):
+        # (task, task_type, rels_key, head_key, target_key, target_words_key, decoder)
+        self._task_plan: List[Tuple[str, str, str, str, str, str, Model]] = [
+            (task, task_type, task + '_rels', task + '_head_indices', task + '_target', task + '_target_words',
+             self.decoders[task])
+            for task, task_type in zip(self.tasks, self.task_types)]
+        # used for the "sum" metric in get_metrics()
+        self._metrics_to_track = frozenset(task if task_type != 'dependency' else 'las'
+                                           for task, task_type in zip(self.tasks, self.task_types))
 
         self.counter = 0
         self.metrics = {}
 
+    def compiled(self, mode: str = "reduce-overhead") -> "MachampModel":
+        """
+        Wraps forward() with torch.compile, which (in "reduce-overhead" mode) captures the
+        many small decoder launches in CUDA graphs. The set of tasks in a batch changes the
+        graph, hence dynamic=True. Requires torch>=2.0, for older versions the model is returned unchanged.
+        """
+        if not hasattr(torch, 'compile'):
+            logger.warning("torch.compile is not available in torch " + torch.__version__ + ", model is not compiled.")
+            return self
+        self.forward = torch.compile(self.forward, mode=mode, fullgraph=False, dynamic=True)
+        return self
+
+    def _autocast(self):
+        # when disabled, do not open an autocast region at all, so that the autocast of the trainer
+        # ("use_amp") stays in effect
+        if not self.bf16_autocast:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type='cuda', dtype=torch.bfloat16)
+
+    def _decoder_streams(self, num_decoders: int, embedded_text: torch.Tensor) -> List[Optional[torch.cuda.Stream]]:
+        """
+        Returns a stream for each decoder to run, these wait for the current stream (which
+        computed the embeddings) before starting. When not enabled, or not on a gpu, None is
+        returned for each decoder, which makes torch.cuda.stream() a no-op.
+        """
+        if not self.parallel_decoders or not embedded_text.is_cuda:
+            return [None] * num_decoders
+        device = embedded_text.device
+        device_streams = self._streams.setdefault(device, [])
+        while len(device_streams) < num_decoders:
+            device_streams.append(torch.cuda.Stream(device=device))
+        current_stream = torch.cuda.current_stream(device)
+        for stream in device_streams[:num_decoders]:
+            stream.wait_stream(current_stream)
+        return device_streams[:num_decoders]
+
+    @staticmethod
+    def _join_streams(streams: List[Optional[torch.cuda.Stream]]) -> None:
+        # the losses are summed on the current stream, so it has to wait until all decoders are done
+        for stream in streams:
+            if stream is not None:
+                torch.cuda.current_stream(stream.device).wait_stream(stream)
+
+    @staticmethod
+    def _zero_loss(device: torch.device) -> torch.Tensor:
+        # used when none of the tasks has gold labels, always fp32 like the summed losses
+        return torch.zeros((), device=device)
+
     def forward(self,
                 tokens: TextFieldTensors,
                 dataset=None,
@@ -57,96 +162,132 @@ class MachampModel(Model):
         """
         """
         gold_labels = kwargs
+        gold_keys = gold_labels.keys()
+        col_idxs = metadata[0]['col_idxs']
 
         tasks_to_handle = []
-        task_types_to_handle = []
-        for task, task_type in zip(self.tasks, self.task_types):
-            s2s_and_in = task_type == "seq2seq" and task + '_target_words' in metadata[0]['col_idxs']
-            dep_and_in = task_type == 'dependency' and task + '_rels' in metadata[0]['col_idxs']
-            if s2s_and_in or dep_and_in or task in metadata[0]['col_idxs']:
-                tasks_to_handle.append(task)
-                task_types_to_handle.append(task_type)
-
-        sent_count = task_types_to_handle.count('classification')
-        mask = get_text_field_mask(tokens)
-
-        embedded_text = self._text_field_embedder(tokens)
-        if sent_count > 0:
-            embedded_text_sent = self.encoder(self._text_field_embedder(tokens), mask=mask)
-
-        if self._dropout:
-            embedded_text = self._dropout(embedded_text)
-            if sent_count > 0:
-                embedded_text_sent = self._dropout_sents(embedded_text_sent)
+        sent_count = 0
+        word_count = 0
+        for entry in self._task_plan:
+            task, task_type, rels_key, _, _, target_words_key, _ = entry
+            s2s_and_in = task_type == 'seq2seq' and target_words_key in col_idxs
+            dep_and_in = task_type == 'dependency' and rels_key in col_idxs
+            if s2s_and_in or dep_and_in or task in col_idxs:
+                tasks_to_handle.append(entry)
+                if task_type == 'classification':
+                    sent_count += 1
+                else:
+                    word_count += 1
+
+        if not tasks_to_handle:
+            # none of the tasks are annotated in this dataset, so there is no need to embed the batch
+            mask = get_text_field_mask(tokens)
+            output_dict = {"logits": {}, "class_probabilities": {}, "mask": mask}
+            if gold_labels:
+                output_dict['loss'] = self._zero_loss(mask.device)
+            if metadata is not None:
+                self._add_metadata(output_dict, metadata)
+            return output_dict
+
+        needs_mask = word_count > 0 or (sent_count > 0 and self._encoder_needs_mask)
+        mask = get_text_field_mask(tokens) if needs_mask else None
 
         logits = {}
         class_probabilities = {}
         output_dict = {"logits": logits,
                        "class_probabilities": class_probabilities}
-        loss = 0.0
-
-        for task, task_type in zip(tasks_to_handle, task_types_to_handle):
-            if task_type == 'classification':
-                task_gold_labels = None if task not in gold_labels else gold_labels[task]
-                pred_output = self.decoders[task].forward(embedded_text_sent, task_gold_labels)
-                class_probabilities[task] = pred_output["class_probabilities"]
-            elif task_type == 'dependency':
-                tags_gold_labels = None if task + '_rels' not in gold_labels else gold_labels[task + '_rels']
-                indices_gold_labels = None if task + '_head_indices' not in gold_labels else gold_labels[task + '_head_indices']
-                pred_output = self.decoders[task].forward(embedded_text, mask=mask,
-                                                          gold_head_tags=tags_gold_labels,
-                                                          gold_head_indices=indices_gold_labels)
-                class_probabilities[task + '_rels'] = pred_output[task + "_rels"]
-                class_probabilities[task + '_head_indices'] = pred_output[task + "_head_indices"]
-            elif task_type == 'unsupervised':
-                task_gold_labels = None if task not in gold_labels else gold_labels[task]
-                pred_output = self.decoders[task].forward(embedded_text, task_gold_labels)
-            elif task_type == 'seq2seq':
-                task_gold_labels = None if task + '_target' not in gold_labels else gold_labels[task + '_target']
-                pred_output = self.decoders[task].forward(embedded_text, mask, task_gold_labels)
-                class_probabilities[task] = pred_output["class_probabilities"]
-            else:
-                task_gold_labels = None if task not in gold_labels else gold_labels[task]
-                pred_output = self.decoders[task].forward(embedded_text, task_gold_labels, mask=mask)
-                class_probabilities[task] = pred_output["class_probabilities"]
-
-            if 'loss' in pred_output:
-                logits[task] = pred_output['loss']
-
-            dep_and_in = task_type == "dependency" and task + "_rels" in gold_labels
-            s2s_and_in = task_type == "seq2seq" and task + '_target_words' in gold_labels
-            if dep_and_in or s2s_and_in or task in gold_labels:
-                loss += pred_output["loss"]
+        loss_terms: List[torch.Tensor] = []
+
+        with self._autocast():
+            embedded_text = self._text_field_embedder(tokens)
+            if sent_count > 0:
+                embedded_text_sent = self.encoder(embedded_text, mask=mask)
+
+            if self._dropout:
+                embedded_text = self._dropout(embedded_text)
+                if sent_count > 0:
+                    embedded_text_sent = self._dropout_sents(embedded_text_sent)
+
+            streams = self._decoder_streams(len(tasks_to_handle), embedded_text)
+            for (task, task_type, rels_key, head_key, target_key, target_words_key, decoder), stream \
+                    in zip(tasks_to_handle, streams):
+                with torch.cuda.stream(stream):
+                    if task_type == 'classification':
+                        task_gold_labels = gold_labels[task] if task in gold_keys else None
+                        pred_output = decoder.forward(embedded_text_sent, task_gold_labels)
+                        class_probabilities[task] = pred_output["class_probabilities"]
+                    elif task_type == 'dependency':
+                        tags_gold_labels = gold_labels[rels_key] if rels_key in gold_keys else None
+                        indices_gold_labels = gold_labels[head_key] if head_key in gold_keys else None
+                        pred_output = decoder.forward(embedded_text, mask=mask,
+                                                      gold_head_tags=tags_gold_labels,
+                                                      gold_head_indices=indices_gold_labels)
+                        class_probabilities[rels_key] = pred_output[rels_key]
+                        class_probabilities[head_key] = pred_output[head_key]
+                    elif task_type == 'unsupervised':
+                        task_gold_labels = gold_labels[task] if task in gold_keys else None
+                        pred_output = decoder.forward(embedded_text, task_gold_labels)
+                    elif task_type == 'seq2seq':
+                        task_gold_labels = gold_labels[target_key] if target_key in gold_keys else None
+                        pred_output = decoder.forward(embedded_text, mask, task_gold_labels)
+                        class_probabilities[task] = pred_output["class_probabilities"]
+                    else:
+                        task_gold_labels = gold_labels[task] if task in gold_keys else None
+                        pred_output = decoder.forward(embedded_text, task_gold_labels, mask=mask)
+                        class_probabilities[task] = pred_output["class_probabilities"]
+
+                    if 'loss' in pred_output:
+                        logits[task] = pred_output['loss']
+
+                    dep_and_in = task_type == "dependency" and rels_key in gold_keys
+                    s2s_and_in = task_type == "seq2seq" and target_words_key in gold_keys
+                    if dep_and_in or s2s_and_in or task in gold_keys:
+                        # losses are summed in fp32, also when running with autocast
+                        loss_terms.append(pred_output["loss"].float())
+            self._join_streams(streams)
 
         if gold_labels:
-            output_dict['loss'] = loss
+            # a single (scripted) stack+sum instead of an addition per task
+            output_dict['loss'] = _sum_losses(loss_terms) if loss_terms else self._zero_loss(embedded_text.device)
 
         if metadata is not None:
-            output_dict["tokens"] = [x["tokens"] for x in metadata]
-            output_dict["full_data"] = [x['full_data'] for x in metadata]
-            output_dict["col_idxs"] = [x['col_idxs'] for x in metadata]
-
-            # Rob: Warning, hacky!, allennlp requires them to be in the length of metadata, in the dump_lines I just use the first
-            output_dict['tasks'] = [self.tasks for _ in metadata]
-            output_dict["task_types"] = [self.task_types for _ in metadata]
-        output_dict['mask'] = mask
+            self._add_metadata(output_dict, metadata)
+        if mask is not None:
+            output_dict['mask'] = mask
         return output_dict
 
+    def _add_metadata(self, output_dict: Dict[str, Any], metadata: List[Dict[str, Any]]) -> None:
+        batch_tokens = []
+        batch_full_data = []
+        batch_col_idxs = []
+        for x in metadata:
+            batch_tokens.append(x['tokens'])
+            batch_full_data.append(x['full_data'])
+            batch_col_idxs.append(x['col_idxs'])
+        output_dict["tokens"] = batch_tokens
+        output_dict["full_data"] = batch_full_data
+        output_dict["col_idxs"] = batch_col_idxs
+
+        # Rob: Warning, hacky!, allennlp requires them to be in the length of metadata, in the dump_lines I just use the first
+        # (these all refer to the same list, which is fine as they are only read)
+        output_dict['tasks'] = [self.tasks] * len(metadata)
+        output_dict["task_types"] = [self.task_types] * len(metadata)
+
     @overrides
     def make_output_human_readable(
         self, output_dict: Dict[str, torch.Tensor]
     ) -> Dict[str, torch.Tensor]:
 
-        for task in self.tasks:
-            is_dep = self.task_types[self.tasks.index(task)] == 'dependency'
-            if task in output_dict['class_probabilities']: 
-                output_dict[task] = self.decoders[task].make_output_human_readable(output_dict['class_probabilities'][task])
-            elif is_dep and task + '_rels' in output_dict['class_probabilities']:
-                dep_tags = output_dict['class_probabilities'][task + '_rels']
-                dep_heads = output_dict['class_probabilities'][task + '_head_indices']
+        class_probabilities = output_dict['class_probabilities']
+        for task, task_type, rels_key, head_key, _, _, decoder in self._task_plan:
+            if task in class_probabilities: 
+                output_dict[task] = decoder.make_output_human_readable(class_probabilities[task])
+            elif task_type == 'dependency' and rels_key in class_probabilities:
+                dep_tags = class_probabilities[rels_key]
+                dep_heads = class_probabilities[head_key]
                 mask = output_dict['mask']
-                output_dict[task + '_rels'], output_dict[task + '_head_indices'] = \
-                                    self.decoders[task].make_output_human_readable(dep_tags, dep_heads, mask)
+                output_dict[rels_key], output_dict[head_key] = \
+                                    decoder.make_output_human_readable(dep_tags, dep_heads, mask)
         
         if output_dict['loss'] == 0:
             output_dict['loss'] = [output_dict['loss']]
@@ -158,28 +299,15 @@ class MachampModel(Model):
         metrics = {}
         for task in self.tasks:
             for name, task_metric in self.decoders[task].get_metrics(reset).items():
-                if name.split("/")[-1] in ["acc", 'ppl']:
-                    metrics[name] = task_metric
-                elif name.split('/')[-1].lower() in ['las']:
-                    metrics[name] = task_metric['LAS']
-                elif name.split('/')[-1] in ['micro-f1', 'macro-f1']:
-                    metrics[name] = task_metric['fscore']
-                elif name.split("/")[-1] == "span_f1":
-                    metrics[name] = task_metric["f1-measure-overall"]
-                elif name.split("/")[-1] == "multi_span_f1":
-                    metrics[name] = task_metric["f1-measure-overall"]
-                elif name.split("/")[-1] == "bleu":
-                    metrics[name] = task_metric["BLEU"]
+                handler = _METRIC_HANDLERS.get(name.rsplit('/', 1)[-1].lower())
+                if handler is not None:
+                    metrics[name] = handler(task_metric)
                 else:
                     logger.error(f"ERROR. Metric: {name} unrecognized.")
         # The "sum" metric summing all tracked metrics keeps a good measure of patience for early stopping and saving
-        metrics_to_track = set()
-        for task, task_type in zip(self.tasks, self.task_types):
-            metrics_to_track.add(task if task_type != 'dependency' else 'las')
-
         metric_sum = 0
         for name, metric in metrics.items():
-            if not name.startswith("_") and set(name.split("/")).intersection(metrics_to_track):
+            if not name.startswith("_") and self._metrics_to_track.intersection(name.split("/")):
                 if not name.endswith("ppl"):
                     metric_sum += metric
 
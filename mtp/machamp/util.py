@@ -4,6 +4,8 @@ import glob
 import logging
 from datetime import datetime
 
+import torch
+
 from allennlp.commands.train import train_model_from_file
 from allennlp.common import Params
 from allennlp.models.archival import load_archive
@@ -104,7 +106,8 @@ def train(config, name, resume):
     return serialization_dir
 
 def predict_model_with_archive(predictor: str, params: Params, archive: str,
-                               input_file: str, output_file: str, batch_size: int = None):
+                               input_file: str, output_file: str, batch_size: int = None,
+                               compile_model: bool = False, tf32: bool = False):
 
     if 'cuda_device' in params['trainer']:
         cuda_device = params['trainer']['cuda_device']
@@ -120,6 +123,15 @@ def predict_model_with_archive(predictor: str, params: Params, archive: str,
         archive.config[item] = params.as_dict()[item]
 
     predictor = MachampPredictor.from_archive(archive, predictor)
+    if compile_model:
+        predictor._model.compiled()
+    if tf32:
+        # note that this is a global setting, it affects all matmuls/convolutions in this process
+        if hasattr(torch.backends.cuda, 'matmul'):
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+        else:
+            logger.warning("TF32 is not supported in torch " + torch.__version__ + ", ignoring --tf32.")
 
     if batch_size == None:
         batch_size = params['data_loader']['batch_sampler']['batch_size']
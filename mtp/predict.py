@@ -25,6 +25,8 @@ parser.add_argument("--dataset", default=None, type=str,
 parser.add_argument("--device", default=None, type=int, help="CUDA device number; set to -1 for CPU")
 parser.add_argument("--batch_size", default=None, type=int, help="The size of each prediction batch")
 parser.add_argument("--raw_text", action="store_true", help="Input raw sentences, one per line in the input file.")
+parser.add_argument("--compile", action="store_true", help="Compile the model with torch.compile (requires torch>=2.0).")
+parser.add_argument("--tf32", action="store_true", help="Allow TF32 matmuls and convolutions on GPUs that support them.")
 args = parser.parse_args()
 
 import_module_and_submodules("machamp")
@@ -73,4 +75,4 @@ if args.dataset:
             del params['dataset_reader']['datasets'][iter_dataset]
 
 util.predict_model_with_archive("machamp_predictor", params, archive_dir, args.input_file, args.pred_file,
-                                batch_size=args.batch_size)
+                                batch_size=args.batch_size, compile_model=args.compile, tf32=args.tf32)